@@ -1,13 +1,14 @@
 """Main FastAPI application."""
 import logging
 import asyncio
+import base64
 import os
 from typing import List, Dict, Set
 from fastapi import FastAPI, HTTPException, Header, Depends
 from fastapi.middleware.cors import CORSMiddleware
 
-from services.image_generator import get_image_generator
-from services.firebase_service import firebase_service
+from services.image_generator import get_image_generator, close_image_generators
+from services.firebase_service import get_firebase_service
 from schemas.models import IllustrationRequest, IllustrationResponse
 
 # ... (logging and app initialization remain)
@@ -42,6 +43,16 @@ app.add_middleware(
     expose_headers=["*"]
 )
 
+@app.on_event("startup")
+async def init_services():
+    """Initialize Firebase clients in each worker process after it has started."""
+    get_firebase_service()
+
+@app.on_event("shutdown")
+async def close_services():
+    """Close pooled HTTP sessions held by the image generators."""
+    await close_image_generators()
+
 async def get_current_user(user_email: str = Header(..., alias="user-email", description="User's email address")):
     """Get or create user from Firestore.
     
@@ -67,7 +78,7 @@ async def get_current_user(user_email: str = Header(..., alias="user-email", des
         }
         
         # Create or update user in Firestore
-        user_id = await firebase_service.create_user(user_data)
+        user_id = await get_firebase_service().create_user(user_data)
         logger.info(f"User {user_email} found or created in Firestore database 'illustration-server' (auth handled on frontend)")
         return user_id
         
@@ -161,7 +172,7 @@ async def generate_illustration_for_stanza(
     stanza_number: int,
     request: IllustrationRequest,
     total_stanzas: int
-) -> str:
+) -> bytes:
     """Generate an illustration for a specific stanza.
     
     Args:
@@ -171,7 +182,7 @@ async def generate_illustration_for_stanza(
         total_stanzas: Total number of stanzas
         
     Returns:
-        Base64 encoded generated image
+        Generated image bytes
     """
     try:
         # Extract data from request
@@ -283,7 +294,7 @@ async def generate_illustration_for_stanza(
 async def generate_storybook_cover(
     request: IllustrationRequest,
     total_stanzas: int
-) -> str:
+) -> bytes:
     """Generate a storybook cover.
     
     Args:
@@ -291,7 +302,7 @@ async def generate_storybook_cover(
         total_stanzas: Total number of stanzas
         
     Returns:
-        Base64 encoded generated cover image
+        Generated cover image bytes
     """
     try:
         # Extract data from request
@@ -357,6 +368,8 @@ async def generate_illustration(
         IllustrationResponse containing the generated images for each stanza
     """
     try:
+        firebase_service = get_firebase_service()
+        
         # Create storybook document
         storybook_id = await firebase_service.create_storybook(
             user_id=user_id,
@@ -405,11 +418,11 @@ async def generate_illustration(
                         storybook_id=storybook_id,
                         user_id=user_id,
                         stanza_number=stanza_num,
-                        image_data=image,
+                        image_bytes=image,
                         prompt=f"Generated for stanza {stanza_num}"
                     )
-                    # Store the Cloud Storage URL in the response
-                    image_data[str(stanza_num)] = image
+                    # Return the image base64 encoded in the response
+                    image_data[str(stanza_num)] = base64.b64encode(image).decode('ascii')
                     logger.info(f"Successfully added illustration for stanza {stanza_num} to storybook {storybook_id} in Firestore")
                 else:
                     errors.append(f"Failed to generate illustration for stanza {stanza_num}")
@@ -440,7 +453,7 @@ async def generate_illustration(
                 cover_url = await firebase_service.upload_cover_to_storage(
                     user_id=user_id,
                     storybook_id=storybook_id,
-                    cover_data=cover_image
+                    cover_bytes=cover_image
                 )
                 
                 # Add cover URL to storybook
@@ -478,7 +491,7 @@ async def generate_illustration(
             status="success",
             message=message,
             image_data=image_data,
-            cover_image=cover_image
+            cover_image=base64.b64encode(cover_image).decode('ascii') if cover_image else None
         )
         
     except ValueError as e:
@@ -9,7 +9,7 @@ from datetime import datetime, timezone
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.insert(0, project_root)
 
-from services.firebase_service import firebase_service
+from services.firebase_service import get_firebase_service
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -18,6 +18,8 @@ logger = logging.getLogger(__name__)
 async def create_collections():
     """Create initial collections and indexes."""
     try:
+        firebase_service = get_firebase_service()
+        
         # Create a test user to verify users collection
         test_user = {
             'uid': 'test-user-123',
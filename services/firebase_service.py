@@ -1,10 +1,18 @@
 """Firebase service for database operations."""
 import os
 import logging
-from typing import Dict, Any, Optional, List
+import asyncio
+import threading
+from functools import lru_cache
+from typing import Dict, Any, Optional, List, Iterable, Union
 from datetime import datetime
+from ulid import ULID
 import firebase_admin
-from firebase_admin import credentials, firestore, storage
+from firebase_admin import credentials, firestore
+from google.api_core.exceptions import Aborted, Conflict
+from google.api_core.retry import Retry, if_exception_type
+from google.cloud import storage as gcs
+from google.cloud.storage.retry import DEFAULT_RETRY
 from google.cloud.firestore import Client
 from google.cloud.firestore_v1.client import Client as FirestoreClient
 import base64
@@ -15,20 +23,53 @@ import io
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Characters stripped from incoming base64 payloads before decoding
+BASE64_WHITESPACE = b' \t\r\n'
+
+# Fields returned for storybook list views
+STORYBOOK_SUMMARY_FIELDS = ['id', 'coverUrl', 'createdAt', 'status']
+
+# (connect, read) timeout in seconds for Cloud Storage uploads
+UPLOAD_TIMEOUT = (5, 120)
+
+# Firestore caps a single batched write at 500 operations
+BATCH_WRITE_LIMIT = 500
+
+# Retry transient contention errors on batch commits with exponential backoff
+BATCH_COMMIT_RETRY = Retry(
+    predicate=if_exception_type(Aborted, Conflict),
+    initial=0.5,
+    maximum=10.0,
+    multiplier=2.0,
+    timeout=60.0
+)
+
+def _maybe_b64decode(data: Union[bytes, str]) -> bytes:
+    """Return raw image bytes, decoding base64 (optionally a data URI) if needed."""
+    if isinstance(data, bytes):
+        return data
+    if data.startswith('data:'):
+        data = data.split(',', 1)[1]
+    return base64.b64decode(data)
+
 class FirebaseService:
     """Firebase service for database operations."""
     
     _instance = None
     _initialized = False
+    _lock = threading.Lock()
     
     def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super(FirebaseService, cls).__new__(cls)
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = super(FirebaseService, cls).__new__(cls)
         return cls._instance
     
     def __init__(self):
         """Initialize Firebase service."""
-        if not self._initialized:
+        with self._lock:
+            if self._initialized:
+                return
             try:
                 # Initialize Firebase Admin SDK
                 if not firebase_admin._apps:
@@ -52,7 +93,11 @@ class FirebaseService:
                     project='cutesom',
                     database='illustration-server'
                 )
-                self.bucket = storage.bucket()
+                
+                # Initialize Cloud Storage client; its authorized session pools
+                # connections across uploads
+                self._storage = gcs.Client(project='cutesom')
+                self.bucket = self._storage.bucket(os.getenv('FIREBASE_STORAGE_BUCKET'))
                 
                 logger.info("Firebase service initialized successfully")
                 self._initialized = True
@@ -73,20 +118,19 @@ class FirebaseService:
             bytes: Processed image data
         """
         try:
-            # Clean up the base64 string
-            if ',' in image_data:
-                image_data = image_data.split(',', 1)[1]
+            # Work on bytes and strip the data URI prefix if present
+            encoded = image_data.encode('ascii', 'ignore') if isinstance(image_data, str) else image_data
+            if encoded.startswith(b'data:'):
+                encoded = encoded.split(b',', 1)[1]
             
-            # Remove any whitespace
-            image_data = image_data.strip().replace('\n', '').replace('\r', '').replace(' ', '')
+            # Remove whitespace in a single pass
+            encoded = encoded.translate(None, BASE64_WHITESPACE)
             
             # Add padding if needed
-            missing_padding = len(image_data) % 4
-            if missing_padding:
-                image_data += '=' * (4 - missing_padding)
+            encoded += b'=' * (-len(encoded) % 4)
             
             # Decode base64 to bytes
-            image_bytes = base64.b64decode(image_data)
+            image_bytes = base64.b64decode(encoded)
             
             # Open image from bytes
             img = Image.open(io.BytesIO(image_bytes))
@@ -167,15 +211,17 @@ class FirebaseService:
             # Preprocess image
             processed_image_bytes = self._preprocess_image(image_data)
             
-            # Create storage path
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            storage_path = f"storybooks/{user_id}/{storybook_id}/request_images/{image_type}_{timestamp}.jpg"
+            # Create storage path (ULIDs are time-sortable and unique per upload)
+            upload_id = str(ULID())
+            storage_path = f"storybooks/{user_id}/{storybook_id}/request_images/{image_type}_{upload_id}.jpg"
             
             # Create blob and upload
             blob = self.bucket.blob(storage_path)
             blob.upload_from_string(
                 processed_image_bytes,
-                content_type='image/jpeg'
+                content_type='image/jpeg',
+                timeout=UPLOAD_TIMEOUT,
+                retry=DEFAULT_RETRY
             )
             
             # Make the blob publicly accessible
@@ -303,7 +349,7 @@ class FirebaseService:
         user_id: str,
         storybook_id: str,
         stanza_number: int,
-        image_data: str
+        image_bytes: Union[bytes, str]
     ) -> str:
         """Upload an image to Cloud Storage.
         
@@ -311,7 +357,7 @@ class FirebaseService:
             user_id: The user's ID
             storybook_id: The storybook's ID
             stanza_number: The stanza number
-            image_data: Base64 encoded image data with data URI prefix
+            image_bytes: Encoded image bytes (base64 strings are still accepted)
             
         Returns:
             str: The public URL of the uploaded image
@@ -323,22 +369,19 @@ class FirebaseService:
         4. Use Firebase Storage SDK on frontend to get authenticated URLs
         """
         try:
-            # Remove data URI prefix if present
-            if image_data.startswith('data:image/jpeg;base64,'):
-                image_data = image_data.replace('data:image/jpeg;base64,', '')
-            
-            # Decode base64 data
-            image_bytes = base64.b64decode(image_data)
+            image_bytes = _maybe_b64decode(image_bytes)
             
             # Create storage path
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            storage_path = f"storybooks/{user_id}/illustrations/{stanza_number}_{timestamp}.jpg"
+            upload_id = str(ULID())
+            storage_path = f"storybooks/{user_id}/illustrations/{stanza_number}_{upload_id}.jpg"
             
             # Create blob and upload
             blob = self.bucket.blob(storage_path)
             blob.upload_from_string(
                 image_bytes,
-                content_type='image/jpeg'
+                content_type='image/jpeg',
+                timeout=UPLOAD_TIMEOUT,
+                retry=DEFAULT_RETRY
             )
             
             # Make the blob publicly accessible
@@ -358,35 +401,32 @@ class FirebaseService:
         self,
         user_id: str,
         storybook_id: str,
-        cover_data: str
+        cover_bytes: Union[bytes, str]
     ) -> str:
         """Upload a storybook cover to Cloud Storage.
         
         Args:
             user_id: The user's ID
             storybook_id: The storybook's ID
-            cover_data: Base64 encoded image data with data URI prefix
+            cover_bytes: Encoded image bytes (base64 strings are still accepted)
             
         Returns:
             str: The public URL of the uploaded cover
         """
         try:
-            # Remove data URI prefix if present
-            if cover_data.startswith('data:image/jpeg;base64,'):
-                cover_data = cover_data.replace('data:image/jpeg;base64,', '')
-            
-            # Decode base64 data
-            image_bytes = base64.b64decode(cover_data)
+            image_bytes = _maybe_b64decode(cover_bytes)
             
             # Create storage path
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            storage_path = f"storybooks/{user_id}/covers/{storybook_id}_{timestamp}.jpg"
+            upload_id = str(ULID())
+            storage_path = f"storybooks/{user_id}/covers/{storybook_id}_{upload_id}.jpg"
             
             # Create blob and upload
             blob = self.bucket.blob(storage_path)
             blob.upload_from_string(
                 image_bytes,
-                content_type='image/jpeg'
+                content_type='image/jpeg',
+                timeout=UPLOAD_TIMEOUT,
+                retry=DEFAULT_RETRY
             )
             
             # Make the blob publicly accessible
@@ -407,7 +447,7 @@ class FirebaseService:
         storybook_id: str,
         user_id: str,
         stanza_number: int,
-        image_data: str,
+        image_bytes: Union[bytes, str],
         prompt: str
     ) -> None:
         """Add an illustration to a storybook.
@@ -416,7 +456,7 @@ class FirebaseService:
             storybook_id: The storybook's ID
             user_id: The user's ID
             stanza_number: The stanza number
-            image_data: Base64 encoded image data
+            image_bytes: Encoded image bytes
             prompt: The prompt used to generate the image
         """
         try:
@@ -425,13 +465,13 @@ class FirebaseService:
                 user_id=user_id,
                 storybook_id=storybook_id,
                 stanza_number=stanza_number,
-                image_data=image_data
+                image_bytes=image_bytes
             )
             
             storybook_ref = self.db.collection('storybooks').document(storybook_id)
             
-            # Get current document
-            doc = storybook_ref.get()
+            # Get current illustrations only
+            doc = storybook_ref.get(field_paths=['illustrations'])
             if not doc.exists:
                 raise ValueError(f"Storybook {storybook_id} not found")
             
@@ -458,6 +498,41 @@ class FirebaseService:
             logger.error(f"Error adding illustration: {str(e)}")
             raise
 
+    async def add_illustrations_bulk(
+        self,
+        storybook_id: str,
+        entries: List[Dict[str, Any]]
+    ) -> None:
+        """Append many illustration entries to a storybook using batched writes.
+        
+        Entries are appended in chunks of up to 500, one ArrayUnion per batch.
+        All chunks update the same document, so batches are committed one after
+        another, retrying transient Aborted/Conflict errors with backoff.
+        
+        Args:
+            storybook_id: The storybook's ID
+            entries: Illustration entries (stanzaNumber, imageUrl, prompt, createdAt)
+        """
+        try:
+            storybook_ref = self.db.collection('storybooks').document(storybook_id)
+            chunks = [
+                entries[i:i + BATCH_WRITE_LIMIT]
+                for i in range(0, len(entries), BATCH_WRITE_LIMIT)
+            ]
+            
+            for chunk in chunks:
+                batch = self.db.batch()
+                batch.update(storybook_ref, {
+                    'illustrations': firestore.ArrayUnion(chunk)
+                })
+                await asyncio.to_thread(batch.commit, retry=BATCH_COMMIT_RETRY)
+            
+            logger.info(f"Added {len(entries)} illustrations to storybook {storybook_id} in {len(chunks)} batches")
+            
+        except Exception as e:
+            logger.error(f"Error adding illustrations in bulk: {str(e)}")
+            raise
+
     async def add_cover_to_storybook(
         self,
         storybook_id: str,
@@ -484,11 +559,21 @@ class FirebaseService:
             logger.error(f"Error adding cover to storybook: {str(e)}")
             raise
 
-    async def get_storybook(self, storybook_id: str) -> Dict[str, Any]:
-        """Get a storybook document."""
+    async def get_storybook(
+        self,
+        storybook_id: str,
+        field_paths: Optional[Iterable[str]] = None
+    ) -> Dict[str, Any]:
+        """Get a storybook document.
+        
+        Args:
+            storybook_id: The storybook's ID
+            field_paths: Optional field paths to project (e.g. 'coverUrl',
+                'illustrations'); fetches the whole document when omitted
+        """
         try:
             storybook_ref = self.db.collection('storybooks').document(storybook_id)
-            storybook_doc = storybook_ref.get()
+            storybook_doc = storybook_ref.get(field_paths=field_paths)
             
             if not storybook_doc.exists:
                 raise ValueError(f"Storybook {storybook_id} not found")
@@ -500,22 +585,31 @@ class FirebaseService:
             raise
     
     async def get_user_storybooks(self, user_id: str) -> List[Dict[str, Any]]:
-        """Get all storybooks for a user."""
+        """Get a summary of all storybooks for a user."""
         try:
-            # Get all storybooks and filter in memory
-            storybooks_ref = self.db.collection('storybooks')
-            storybooks = []
-            
-            for doc in storybooks_ref.stream():
-                data = doc.to_dict()
-                if data.get('userId') == user_id:
-                    storybooks.append(data)
+            # Filter server-side and project only the list-view fields so the
+            # illustrations array and request payload are never transferred
+            query = (
+                self.db.collection('storybooks')
+                .where('userId', '==', user_id)
+                .select(STORYBOOK_SUMMARY_FIELDS)
+            )
             
-            return storybooks
+            # Drain the blocking stream on a worker thread so other requests
+            # keep being served while the rows arrive
+            return await asyncio.to_thread(
+                lambda: [doc.to_dict() for doc in query.stream()]
+            )
             
         except Exception as e:
             logger.error(f"Error getting user storybooks: {str(e)}")
             raise
 
-# Create singleton instance
-firebase_service = FirebaseService() 
\ No newline at end of file
+@lru_cache(maxsize=1)
+def get_firebase_service() -> FirebaseService:
+    """Return the process-wide Firebase service, initializing it on first use.
+    
+    Initialization is deferred until a worker calls this (e.g. on app startup)
+    so credentials and gRPC channels are never created in a pre-fork parent.
+    """
+    return FirebaseService() 
\ No newline at end of file
@@ -1,4 +1,4 @@
 from .base import ImageGenerator
-from .factory import get_image_generator
+from .factory import get_image_generator, close_image_generators
 
-__all__ = ['ImageGenerator', 'get_image_generator']
+__all__ = ['ImageGenerator', 'get_image_generator', 'close_image_generators']
@@ -1,9 +1,103 @@
+import asyncio
+import functools
+import hashlib
+import logging
+import os
+import pybase64
+import aiohttp
 from abc import ABC, abstractmethod
-from typing import List, Optional
+from collections import OrderedDict
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Resolve pybase64's CPU-dispatched codec once at import (NEON on arm64,
+# SSSE3/AVX2 on x86_64) and bind the callables for the generators' hot paths
+pybase64.get_version()
+b64encode = pybase64.b64encode
+b64decode = pybase64.b64decode
+
+# Prefer compact encodings from hosts that negotiate image formats. aiohttp
+# already advertises and transparently decodes the transfer encodings it supports.
+REFERENCE_REQUEST_HEADERS = {
+    'Accept': 'image/webp,image/jpeg;q=0.9,image/*;q=0.8',
+}
+
+# Upper bound on a reference image payload (data URI length or HTTP body size)
+MAX_REFERENCE_BYTES = 16 * 1024 * 1024
+
+# Read size used when streaming reference image bodies
+REFERENCE_READ_CHUNK_SIZE = 64 * 1024
+
+# Number of fetched reference images kept per generator; stanzas of a storybook
+# share the same baby/parent photos
+REFERENCE_CACHE_SIZE = 32
+
+# Total bytes of cached reference images kept per generator
+REFERENCE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Seconds a cached reference lives, measured from its fetch. Long enough for one
+# storybook's stanzas, short enough that user photos aren't held indefinitely.
+REFERENCE_CACHE_TTL = 600.0
+
+# Threads for the blocking model SDK calls (10-60 s each). They get their own
+# pool so short asyncio.to_thread jobs never queue behind a storybook's stanzas
+# on the default executor, which has only 5 threads on a 1-CPU instance.
+GENERATION_WORKERS = int(os.getenv('GENERATION_WORKERS', '16'))
+
+_generation_executor: Optional[ThreadPoolExecutor] = None
+
+def _get_generation_executor() -> ThreadPoolExecutor:
+    """Return the shared model SDK executor, creating it on first use."""
+    global _generation_executor
+    if _generation_executor is None:
+        _generation_executor = ThreadPoolExecutor(
+            max_workers=GENERATION_WORKERS,
+            thread_name_prefix='image-generation'
+        )
+    return _generation_executor
+
+def shutdown_generation_executor() -> None:
+    """Stop the model SDK executor (called on app shutdown)."""
+    global _generation_executor
+    if _generation_executor is not None:
+        _generation_executor.shutdown(wait=False, cancel_futures=True)
+        _generation_executor = None
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+JPEG_SIGNATURE = b'\xff\xd8\xff'
+
+def sniff_mime_type(data: bytes) -> Optional[str]:
+    """Identify the image MIME type from its leading magic bytes."""
+    if data.startswith(JPEG_SIGNATURE):
+        return 'image/jpeg'
+    if data.startswith(PNG_SIGNATURE):
+        return 'image/png'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    if data.startswith((b'GIF87a', b'GIF89a')):
+        return 'image/gif'
+    return None
+
+@dataclass
+class _ReferenceCacheEntry:
+    """A cached reference fetch, with its expiry time and size once complete."""
+    future: asyncio.Future
+    expires_at: float
+    size: int = 0
 
 class ImageGenerator(ABC):
     """Abstract base class for image generation services."""
 
+    # Reference image session, created lazily on the serving event loop
+    _session: Optional[aiohttp.ClientSession] = None
+
+    # LRU of reference fetches keyed by URL (or data URI digest), created lazily
+    _reference_cache: Optional["OrderedDict[str, _ReferenceCacheEntry]"] = None
+    _reference_cache_bytes: int = 0
+
     @abstractmethod
     async def generate_illustration(
         self,
@@ -11,16 +105,164 @@ class ImageGenerator(ABC):
         reference_images: List[str],
         size: str = "1024x1024",
         quality: str = "standard",
-    ) -> Optional[str]:
+    ) -> Optional[bytes]:
         """Generate an illustration based on the prompt and reference images.
-        
+
         Args:
             prompt: The text prompt for generation.
             reference_images: List of reference image URLs (or base64 if supported).
             size: Target size string (e.g., "1024x1024").
             quality: Quality setting (e.g., "standard", "high").
-            
+
         Returns:
-            Optional[str]: Base64 encoded image data or None if failed.
+            Optional[bytes]: Encoded image bytes (PNG/JPEG) or None if failed.
         """
         pass
+
+    async def close(self) -> None:
+        """Release any network resources held by the generator."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._reference_cache = None
+        self._reference_cache_bytes = 0
+
+    async def _run_generation(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Run a blocking model SDK call on the dedicated generation executor."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            _get_generation_executor(),
+            functools.partial(func, *args, **kwargs)
+        )
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Return the shared keep-alive session, creating it on first use."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=16,
+                limit_per_host=8,
+                ttl_dns_cache=300,
+                keepalive_timeout=60
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def _fetch_image(
+        self,
+        url: str,
+        session: aiohttp.ClientSession
+    ) -> Optional[Tuple[bytes, str]]:
+        """Fetch an image from a URL or data URI and return its bytes and MIME type."""
+        try:
+            if url.startswith('data:'):
+                # Handle data URI, rejecting oversized payloads before decoding
+                if len(url) > MAX_REFERENCE_BYTES:
+                    logger.warning(f"Skipping data URI reference of {len(url)} chars (limit {MAX_REFERENCE_BYTES})")
+                    return None
+                try:
+                    # Decode just the payload after the comma; the header is unused.
+                    # Line-wrapped payloads and trailing newlines are tolerated.
+                    data = b64decode(url[url.index(',') + 1:], validate=False)
+                except Exception as e:
+                    logger.error(f"Error decoding data URI: {str(e)}")
+                    return None
+                mime_type = sniff_mime_type(data)
+            else:
+                async with session.get(url, headers=REFERENCE_REQUEST_HEADERS) as response:
+                    if response.status != 200:
+                        logger.error(f"Failed to fetch image from {url}: {response.status}")
+                        return None
+                    if response.content_length and response.content_length > MAX_REFERENCE_BYTES:
+                        logger.warning(f"Skipping reference image {url} of {response.content_length} bytes (limit {MAX_REFERENCE_BYTES})")
+                        return None
+                    # Read in chunks so chunked or compressed bodies are bounded too
+                    data = bytearray()
+                    async for chunk in response.content.iter_chunked(REFERENCE_READ_CHUNK_SIZE):
+                        data += chunk
+                        if len(data) > MAX_REFERENCE_BYTES:
+                            logger.warning(f"Skipping reference image {url} larger than {MAX_REFERENCE_BYTES} bytes")
+                            return None
+                    data = bytes(data)
+                    mime_type = sniff_mime_type(data) or response.content_type
+
+            if not mime_type or not mime_type.startswith('image/'):
+                logger.error(f"Unrecognized reference image type: {mime_type}")
+                return None
+            return data, mime_type
+        except Exception as e:
+            # Truncate long data URIs in logs to avoid spam
+            log_url = url[:100] + "..." if len(url) > 100 else url
+            logger.error(f"Error fetching image {log_url}: {str(e)}")
+            return None
+
+    async def _fetch_cached_image(
+        self,
+        url: str,
+        session: aiohttp.ClientSession
+    ) -> Optional[Tuple[bytes, str]]:
+        """Fetch a reference image through the LRU cache.
+        
+        The cache stores in-flight fetches, so stanzas generated in parallel
+        share a single download of the same photo. It is bounded by entry count,
+        total bytes and age; failed fetches are evicted.
+        """
+        if url.startswith('data:'):
+            key = 'data:' + hashlib.blake2b(url.encode(), digest_size=16).hexdigest()
+        else:
+            key = url
+        
+        if self._reference_cache is None:
+            self._reference_cache = OrderedDict()
+        cache = self._reference_cache
+        
+        now = asyncio.get_running_loop().time()
+        for expired in [k for k, e in cache.items() if e.expires_at <= now]:
+            self._drop_cached_reference(expired)
+        
+        entry = cache.get(key)
+        if entry is not None:
+            cache.move_to_end(key)
+        else:
+            future = asyncio.ensure_future(self._fetch_image(url, session))
+            entry = _ReferenceCacheEntry(future, now + REFERENCE_CACHE_TTL)
+            cache[key] = entry
+            future.add_done_callback(functools.partial(self._account_cached_reference, key, entry))
+            if len(cache) > REFERENCE_CACHE_SIZE:
+                self._drop_cached_reference(next(iter(cache)))
+        
+        # Shield the shared fetch so one caller's cancellation doesn't cancel it for all
+        result = await asyncio.shield(entry.future)
+        if result is None and cache.get(key) is entry:
+            self._drop_cached_reference(key)
+        return result
+
+    def _account_cached_reference(
+        self,
+        key: str,
+        entry: _ReferenceCacheEntry,
+        future: asyncio.Future
+    ) -> None:
+        """Record a completed fetch's size and evict LRU entries over the byte budget."""
+        cache = self._reference_cache
+        if cache is None or cache.get(key) is not entry:
+            return
+        if future.cancelled() or future.exception() is not None or future.result() is None:
+            return
+        entry.size = len(future.result()[0])
+        self._reference_cache_bytes += entry.size
+        while self._reference_cache_bytes > REFERENCE_CACHE_MAX_BYTES and cache:
+            self._drop_cached_reference(next(iter(cache)))
+
+    def _drop_cached_reference(self, key: str) -> None:
+        """Remove a reference from the cache and release its byte budget."""
+        entry = self._reference_cache.pop(key)
+        self._reference_cache_bytes -= entry.size
+
+    async def _fetch_reference_images(self, urls: List[str]) -> List[Tuple[bytes, str]]:
+        """Fetch reference images concurrently over the pooled session, dropping failures."""
+        session = await self._get_session()
+        results = await asyncio.gather(
+            *(self._fetch_cached_image(url, session) for url in urls),
+            return_exceptions=True
+        )
+        return [result for result in results if isinstance(result, tuple)]
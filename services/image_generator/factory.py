@@ -1,26 +1,49 @@
 import os
 import logging
-from .base import ImageGenerator
+from typing import Dict
+from .base import ImageGenerator, shutdown_generation_executor
 from .openai_generator import OpenAIGenerator
 from .gemini_generator import GeminiGenerator
 
 logger = logging.getLogger(__name__)
 
+SUPPORTED_MODELS = ('nano-banana', 'gpt-image')
+
+# Generators created so far, keyed by normalized model alias
+_generators: Dict[str, ImageGenerator] = {}
+
 def get_image_generator(model_alias: str = "gpt-image") -> ImageGenerator:
     """Factory function to get the configured image generator.
-    
+
+    Generators are cached per model, so their API clients and connection
+    pools are reused across stanzas and requests.
+
     Args:
         model_alias: The alias of the model to use ('nano-banana' or 'gpt-image').
     """
     # Normalize input
     alias = model_alias.lower()
-    
+
+    if alias not in SUPPORTED_MODELS:
+        logger.warning(f"Unknown model alias '{model_alias}', falling back to OpenAI")
+        alias = 'gpt-image'
+
+    if alias not in _generators:
+        _generators[alias] = _create_image_generator(alias)
+    return _generators[alias]
+
+def _create_image_generator(alias: str) -> ImageGenerator:
+    """Instantiate the generator for a normalized model alias."""
     if alias == 'nano-banana':
         logger.info("Using Gemini Image Generator (Nano Banana)")
         return GeminiGenerator()
-    elif alias == 'gpt-image':
-        logger.info("Using OpenAI Image Generator")
-        return OpenAIGenerator()
-    else:
-        logger.warning(f"Unknown model alias '{model_alias}', falling back to OpenAI")
-        return OpenAIGenerator()
+    logger.info("Using OpenAI Image Generator")
+    return OpenAIGenerator()
+
+async def close_image_generators() -> None:
+    """Close and forget all cached generators (called on app shutdown)."""
+    generators = list(_generators.values())
+    _generators.clear()
+    for generator in generators:
+        await generator.close()
+    shutdown_generation_executor()
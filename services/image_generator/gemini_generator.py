@@ -1,16 +1,55 @@
 import logging
 import os
 import io
-import base64
+import asyncio
 import aiohttp
-from typing import List, Optional
-from google import genai
-from google.genai import types
-from PIL import Image
-from .base import ImageGenerator
+from typing import List, Optional, Tuple
+from .base import ImageGenerator, PNG_SIGNATURE, JPEG_SIGNATURE, b64decode
 
 logger = logging.getLogger(__name__)
 
+# Containers accepted from the image models; limits PIL's format probing.
+# Keep in step with IMAGE_SIGNATURES.
+RESPONSE_FORMATS = ["PNG", "JPEG", "WEBP", "GIF"]
+
+# Largest reference image dimensions worth sending to the model
+REFERENCE_MAX_SIZE = (1024, 1024)
+
+# Decompression-bomb guard: refuse references with more pixels than this
+REFERENCE_MAX_PIXELS = 50_000_000
+
+# Leading bytes of the raw image containers in RESPONSE_FORMATS
+IMAGE_SIGNATURES = (PNG_SIGNATURE, JPEG_SIGNATURE, b'RIFF', b'GIF8')
+
+# Supported output formats and the signature identifying each container
+OUTPUT_SIGNATURES = {
+    'JPEG': JPEG_SIGNATURE,
+    'PNG': PNG_SIGNATURE,
+}
+
+# Model output in any supported output format is passed through untouched
+PASSTHROUGH_SIGNATURES = tuple(OUTPUT_SIGNATURES.values())
+
+def _shrink_reference_image(data: bytes, mime_type: str) -> Tuple[bytes, str]:
+    """Downscale oversized reference images to JPEG; smaller ones are returned as-is."""
+    from PIL import Image
+    
+    img = Image.open(io.BytesIO(data))
+    if img.width * img.height > REFERENCE_MAX_PIXELS:
+        raise ValueError(f"Reference image {img.width}x{img.height} exceeds {REFERENCE_MAX_PIXELS} pixels")
+    if img.width <= REFERENCE_MAX_SIZE[0] and img.height <= REFERENCE_MAX_SIZE[1]:
+        return data, mime_type
+    
+    # For JPEGs, let libjpeg-turbo decode directly at a reduced scale
+    img.draft('RGB', REFERENCE_MAX_SIZE)
+    img.thumbnail(REFERENCE_MAX_SIZE, Image.Resampling.BILINEAR)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    
+    buffered = io.BytesIO()
+    img.save(buffered, format="JPEG", quality=85)
+    return buffered.getvalue(), 'image/jpeg'
+
 class GeminiGenerator(ImageGenerator):
     """Gemini implementation of the ImageGenerator using Imagen 3."""
     
@@ -25,6 +64,19 @@ class GeminiGenerator(ImageGenerator):
             # or allow override.
             self.model_name = os.environ.get('GEMINI_MODEL_ID', 'gemini-3-pro-image-preview') 
             
+            # Container used when model output must be converted (e.g. WEBP/GIF);
+            # PNG and JPEG output is returned as-is. JPEG encodes much faster than PNG
+            self.output_format = os.environ.get('GEMINI_OUTPUT_FORMAT', 'JPEG').upper()
+            if self.output_format not in OUTPUT_SIGNATURES:
+                logger.warning(f"Unsupported GEMINI_OUTPUT_FORMAT '{self.output_format}', using JPEG")
+                self.output_format = 'JPEG'
+            
+            # Import the SDK on first construction so workers that never use
+            # Gemini don't pay its import cost
+            from google import genai
+            from google.genai import types
+            self._types = types
+            
             # Using the new SDK client
             self.client = genai.Client(api_key=api_key)
             logger.info(f"GeminiGenerator initialized with model: {self.model_name}")
@@ -33,31 +85,19 @@ class GeminiGenerator(ImageGenerator):
             logger.error(f"Error initializing GeminiGenerator: {str(e)}")
             raise
 
-    async def _fetch_image(self, url: str) -> Optional[Image.Image]:
-        """Fetch an image from a URL or data URI and return as PIL Image."""
+    async def _fetch_image(
+        self,
+        url: str,
+        session: aiohttp.ClientSession
+    ) -> Optional[Tuple[bytes, str]]:
+        """Fetch a reference image, downscaling it if oversized."""
+        image = await super()._fetch_image(url, session)
+        if image is None:
+            return None
         try:
-            if url.startswith('data:'):
-                # Handle data URI
-                try:
-                    header, encoded = url.split(',', 1)
-                    data = base64.b64decode(encoded)
-                    return Image.open(io.BytesIO(data))
-                except Exception as e:
-                    logger.error(f"Error decoding data URI: {str(e)}")
-                    return None
-                
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as response:
-                    if response.status == 200:
-                        data = await response.read()
-                        return Image.open(io.BytesIO(data))
-                    else:
-                        logger.error(f"Failed to fetch image from {url}: {response.status}")
-                        return None
+            return await asyncio.to_thread(_shrink_reference_image, *image)
         except Exception as e:
-            # Truncate long data URIs in logs to avoid spam
-            log_url = url[:100] + "..." if len(url) > 100 else url
-            logger.error(f"Error fetching image {log_url}: {str(e)}")
+            logger.error(f"Error resizing reference image: {str(e)}")
             return None
 
     async def generate_illustration(
@@ -65,7 +105,7 @@ class GeminiGenerator(ImageGenerator):
         prompt: str,
         reference_images: List[str],
 
-    ) -> Optional[str]:
+    ) -> Optional[bytes]:
         """Generate illustration using Gemini / Imagen 3."""
         try:
             logger.info(f"Generating illustration (Gemini: {self.model_name})")
@@ -73,22 +113,25 @@ class GeminiGenerator(ImageGenerator):
             # Fetch reference images
             contents = [prompt]
             if reference_images:
-                valid_refs = 0
-                for url in reference_images:
-                    if img := await self._fetch_image(url):
-                        contents.append(img)
-                        valid_refs += 1
-                logger.info(f"Included {valid_refs} reference images")
+                # Hand the encoded bytes straight to the SDK without decoding them
+                valid_images = [
+                    self._types.Part.from_bytes(data=data, mime_type=mime_type)
+                    for data, mime_type in await self._fetch_reference_images(reference_images)
+                ]
+                contents.extend(valid_images)
+                logger.info(f"Included {len(valid_images)} reference images")
 
             # Generate
             try:
-                # Use generate_images for correctness with image generation models
-                response = self.client.models.generate_images(
+                # Use generate_images for correctness with image generation models.
+                # The SDK call is blocking, so run it on the generation executor.
+                response = await self._run_generation(
+                    self.client.models.generate_images,
                     model=self.model_name,
                     contents=contents,
-                    config=types.GenerateContentConfig(
+                    config=self._types.GenerateContentConfig(
                         response_modalities=["IMAGE"],
-                        image_config=types.ImageConfig(
+                        image_config=self._types.ImageConfig(
                             aspect_ratio="16:9",
                         ),
                     )
@@ -107,13 +150,13 @@ class GeminiGenerator(ImageGenerator):
             for candidate in candidates:
                 # Handle 'GeneratedImage' object (from generate_images)
                 if hasattr(candidate, 'image') and hasattr(candidate.image, 'image_bytes'):
-                    return self._process_image_bytes(candidate.image.image_bytes)
+                    return await self._finalize_image(candidate.image.image_bytes)
                 
                 # Handle 'Candidate' object (from generate_content fallback/mix)
                 if hasattr(candidate, 'content') and candidate.content.parts:
                     for part in candidate.content.parts:
                         if hasattr(part, 'inline_data') and part.inline_data:
-                             return self._process_image_bytes(part.inline_data.data)
+                             return await self._finalize_image(part.inline_data.data)
             
             logger.error("No valid image data found in response.")
             return None
@@ -122,31 +165,54 @@ class GeminiGenerator(ImageGenerator):
             logger.error(f"Error calling Gemini: {str(e)}", exc_info=True)
             return None
 
-    def _process_image_bytes(self, data: bytes) -> Optional[str]:
-        """Validate and convert raw image bytes (or base64 bytes) to a clean base64 string."""
+    async def _finalize_image(self, data: bytes) -> Optional[bytes]:
+        """Return model output as PNG or JPEG.
+        
+        PNG and JPEG bytes are returned directly without leaving the event
+        loop or touching PIL; anything else is converted to the configured
+        format in a worker thread (PIL releases the GIL while decoding and encoding).
+        """
+        if data and data.startswith(PASSTHROUGH_SIGNATURES):
+            return data
+        return await asyncio.to_thread(self._process_image_bytes, data)
+
+    def _process_image_bytes(self, data: bytes) -> Optional[bytes]:
+        """Validate raw image bytes (or base64 bytes), converting non-PNG/JPEG images to the configured output format."""
         if not data:
             return None
-            
-        try:
-            # 1. Try treating as raw binary image
-            img = Image.open(io.BytesIO(data))
-            img.verify()
-            img = Image.open(io.BytesIO(data)) # Re-open after verify
-        except Exception:
+        
+        # Payloads without a known image signature are treated as base64 text,
+        # tolerating line breaks and trailing newlines
+        if not data.startswith(IMAGE_SIGNATURES):
             try:
-                # 2. Fallback: Try treating as base64 encoded bytes
-                decoded = base64.b64decode(data)
-                img = Image.open(io.BytesIO(decoded))
-                img.verify()
-                img = Image.open(io.BytesIO(decoded))
-            except Exception:
+                data = b64decode(data, validate=False)
+            except ValueError:
                 logger.error("Failed to process bytes: neither valid raw image nor base64 image.")
                 return None
+        
+        # Already PNG or JPEG: skip the decode/re-encode round-trip
+        if data.startswith(PASSTHROUGH_SIGNATURES):
+            return data
+        
+        from PIL import Image
+            
+        try:
+            # load() decodes fully and raises on a corrupt stream
+            img = Image.open(io.BytesIO(data), formats=RESPONSE_FORMATS)
+            img.load()
+        except Exception:
+            logger.error("Failed to process bytes: not a valid image.")
+            return None
 
-        # Convert to consistent PNG format
+        # Convert to the consistent output format
         buffered = io.BytesIO()
-        img.save(buffered, format="PNG")
-        b64_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
-        logger.info(f"Successfully processed image. Output size: {len(b64_str)} chars")
-        return b64_str
+        if self.output_format == 'JPEG':
+            if img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+            img.save(buffered, format="JPEG", quality=90, optimize=False, subsampling=2, progressive=False)
+        else:
+            img.save(buffered, format="PNG")
+        image_bytes = buffered.getvalue()
+        logger.info(f"Successfully processed image. Output size: {len(image_bytes)} bytes")
+        return image_bytes
 
@@ -1,8 +1,8 @@
 import logging
 import os
+import asyncio
 from typing import List, Optional
-from openai import OpenAI
-from .base import ImageGenerator
+from .base import ImageGenerator, b64encode, b64decode
 
 logger = logging.getLogger(__name__)
 
@@ -17,6 +17,9 @@ class OpenAIGenerator(ImageGenerator):
                 # We log a warning instead of raising, in case only other providers are used
                 logger.warning("OPENAI_API_KEY not set. OpenAIGenerator will fail if used.")
             
+            # Imported here so workers that never use OpenAI skip the SDK import
+            from openai import OpenAI
+            
             self.client = OpenAI(
                 api_key=api_key,
                 base_url="https://api.openai.com/v1"
@@ -27,18 +30,43 @@ class OpenAIGenerator(ImageGenerator):
             logger.error(f"Error initializing OpenAIGenerator: {str(e)}")
             raise
 
+    async def _inline_reference_images(self, reference_images: List[str]) -> List[str]:
+        """Prefetch remote reference images over the pooled session as data URLs.
+        
+        Data URIs are passed through unchanged; references that fail to
+        download are dropped.
+        """
+        session = await self._get_session()
+        
+        async def to_data_url(url: str) -> Optional[str]:
+            if url.startswith('data:'):
+                return url
+            image = await self._fetch_cached_image(url, session)
+            if image is None:
+                return None
+            data, mime_type = image
+            return f"data:{mime_type};base64,{b64encode(data).decode('ascii')}"
+        
+        results = await asyncio.gather(*(to_data_url(url) for url in reference_images))
+        return [url for url in results if url]
+
     async def generate_illustration(
         self,
         prompt: str,
         reference_images: List[str],
         size: str = "1536x1024",
         quality: str = "high",
-    ) -> Optional[str]:
+    ) -> Optional[bytes]:
         """Generate illustration using OpenAI DALL-E 3 / GPT-4 Vision."""
         try:
             logger.info(f"Generating illustration (OpenAI) size: {size}, quality: {quality}")
             
-            response = self.client.responses.create(
+            # Inline remote references so OpenAI doesn't have to fetch them itself
+            image_urls = await self._inline_reference_images(reference_images)
+            
+            # The SDK call is blocking, so run it on the generation executor
+            response = await self._run_generation(
+                self.client.responses.create,
                 model="gpt-4.1", # Keeping the model from original code
                 tools=[{"type": "image_generation"}],
                 input=[
@@ -59,7 +87,7 @@ class OpenAIGenerator(ImageGenerator):
                                     "image_url": image_url,
                                     "detail": "auto"
                                 }
-                                for image_url in reference_images
+                                for image_url in image_urls
                             ]
                         ]
                     }
@@ -68,10 +96,10 @@ class OpenAIGenerator(ImageGenerator):
             
             for output in response.output:
                 if hasattr(output, 'result') and output.result:
-                    res = output.result
-                    if isinstance(res, str):
-                        logger.info(f"OpenAI generated image size: {len(res)} chars")
-                    return res
+                    # The Responses API returns the image as base64
+                    image_bytes = b64decode(output.result)
+                    logger.info(f"OpenAI generated image size: {len(image_bytes)} bytes")
+                    return image_bytes
                     
             logger.error("No image data found in OpenAI response")
             return None
@@ -8,7 +8,7 @@ from datetime import datetime
 # Add the project root directory to Python path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from services.firebase_service import firebase_service
+from services.firebase_service import get_firebase_service
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -17,6 +17,8 @@ logger = logging.getLogger(__name__)
 async def test_firestore_access():
     """Test basic Firestore access and all collections."""
     try:
+        firebase_service = get_firebase_service()
+        
         # Test user data
         test_user = {
             'uid': 'test-user-123',
@@ -1,11 +1,23 @@
 """Test script for the illustration generation service."""
-import base64
-import json
 import logging
+import mmap
 import os
 from pathlib import Path
-import requests
-from typing import Dict, Any
+import httpx
+import ijson
+import orjson
+from typing import Dict, Any, Union
+
+# Prefer the SIMD-accelerated pybase64 codec when installed
+try:
+    import pybase64 as base64
+    b64encode_as_string = base64.b64encode_as_string
+except ImportError:
+    import base64
+
+    def b64encode_as_string(data: bytes) -> str:
+        """Stdlib fallback for pybase64.b64encode_as_string."""
+        return base64.b64encode(data).decode('ascii')
 
 # Configure logging
 logging.basicConfig(
@@ -20,6 +32,20 @@ SERVICE_URL = os.getenv("SERVICE_URL", "http://localhost:8000")
 TEST_IMAGES_DIR = Path(__file__).parent / "test_images"
 OUTPUT_DIR = Path(__file__).parent / "output"
 TEST_USER_EMAIL = "test-user@example.com"  # Test user email
+JPEG_DATA_URI_PREFIX = "data:image/jpeg;base64,"
+DECODE_CHUNK_CHARS = 64 * 1024  # Multiple of 4, so each slice decodes on its own
+
+# Shared HTTP/2 client so repeated calls multiplex over one pooled connection.
+# Generating a full storybook takes minutes, hence the long read timeout.
+_CLIENT = httpx.Client(
+    headers={"user-email": TEST_USER_EMAIL},
+    timeout=httpx.Timeout(600.0, connect=10.0),
+    transport=httpx.HTTPTransport(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=16),
+        retries=3
+    )
+)
 
 def ensure_directories():
     """Ensure test and output directories exist."""
@@ -30,13 +56,23 @@ def load_image_as_base64(image_path: Path) -> str:
     """Load an image file and convert it to base64."""
     try:
         with open(image_path, "rb") as image_file:
-            base64_data = base64.b64encode(image_file.read()).decode('utf-8')
-            return f"data:image/jpeg;base64,{base64_data}"
+            # mmap can't map an empty file
+            if os.fstat(image_file.fileno()).st_size == 0:
+                return JPEG_DATA_URI_PREFIX
+            # Encode straight from the mapped pages to str and prepend the prefix in one concatenation
+            with mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return JPEG_DATA_URI_PREFIX + b64encode_as_string(mapped)
     except Exception as e:
-        logger.error(f"Error loading image {image_path}: {str(e)}")
+        logger.error("Error loading image %s: %s", image_path, e)
         return ""
 
-def create_test_request() -> Dict[str, Any]:
+# Minimal placeholder base64 string (1x1 transparent pixel)
+PLACEHOLDER_PHOTO = "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNkYAAAAAYAAjCB0C8AAAAASUVORK5CYII="
+
+# Sentinel photo value spliced out of the pre-serialized request template
+PHOTO_SLOT = "__PHOTO__"
+
+def create_test_request(placeholder_photo: str = PLACEHOLDER_PHOTO) -> Dict[str, Any]:
     """Create a test request payload."""
     # Sample poem with multiple stanzas
     poem = """Little star so bright and true,
@@ -45,9 +81,6 @@ Twinkling like a diamond bright,
 Making everything just right.
 """
 
-    # Minimal placeholder base64 string (1x1 transparent pixel)
-    placeholder_photo = "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNkYAAAAAYAAjCB0C8AAAAASUVORK5CYII="
-
     # Create request payload
     request = {
         "poem_text": poem,
@@ -80,66 +113,119 @@ Making everything just right.
     }
     return request
 
+# Request body serialized once, with a sentinel in every photo slot
+_REQUEST_TEMPLATE = orjson.dumps(create_test_request(PHOTO_SLOT))
+
+def build_test_request_body(photo: str = PLACEHOLDER_PHOTO) -> bytes:
+    """Return the serialized test request with the given photo in every slot.
+    
+    Photos are base64 data URIs, which never need JSON escaping, so they can
+    be spliced into the pre-serialized template with a single bytes.replace.
+    """
+    return _REQUEST_TEMPLATE.replace(PHOTO_SLOT.encode('ascii'), photo.encode('ascii'))
+
 def save_raw_response(response_data: Dict[str, Any]):
     """Save the raw response data to a JSON file."""
     try:
         output_path = OUTPUT_DIR / "raw_response.json"
-        with open(output_path, "w") as f:
-            json.dump(response_data, f, indent=2)
-        logger.info(f"Saved raw response to {output_path}")
+        with open(output_path, "wb") as f:
+            f.write(orjson.dumps(response_data, option=orjson.OPT_INDENT_2))
+        logger.info("Saved raw response to %s", output_path)
     except Exception as e:
-        logger.error(f"Error saving raw response: {str(e)}")
+        logger.error("Error saving raw response: %s", e)
 
-def save_generated_images(response_data: Dict[str, Any]):
-    """Save generated images from the response."""
+def base64_payload(data_uri: str) -> memoryview:
+    """Return the base64 payload of a JPEG data URI (or bare base64) as ASCII bytes.
+    
+    The prefix is dropped by slicing a memoryview, so no second copy of the
+    payload is made after the single ASCII encode.
+    """
+    payload = memoryview(data_uri.encode('ascii'))
+    if data_uri.startswith(JPEG_DATA_URI_PREFIX):
+        payload = payload[len(JPEG_DATA_URI_PREFIX):]
+    return payload
+
+def write_base64_to_file(encoded: Union[str, bytes, memoryview], output_path: Path):
+    """Decode a base64 string to a file in fixed-size slices.
+    
+    Avoids holding the full decoded image in memory alongside the base64 text.
+    Slices go straight to the file descriptor without a userland write buffer.
+    A partially written file is removed if decoding fails.
+    """
+    fd = os.open(output_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
     try:
-        # Get image_data from response
-        image_data = response_data.get("image_data", {})
-        if not image_data:
-            logger.error("No image_data found in response")
-            return
+        for start in range(0, len(encoded), DECODE_CHUNK_CHARS):
+            chunk = memoryview(base64.b64decode(encoded[start:start + DECODE_CHUNK_CHARS], validate=False))
+            while chunk:
+                chunk = chunk[os.write(fd, chunk):]
+    except Exception:
+        os.close(fd)
+        output_path.unlink(missing_ok=True)
+        raise
+    os.close(fd)
 
-        for stanza_num, image_data in image_data.items():
-            # Remove data URI prefix if present
-            if image_data.startswith("data:image/jpeg;base64,"):
-                image_data = image_data.replace("data:image/jpeg;base64,", "")
-            
-            # Decode base64 image
-            try:
-                image_bytes = base64.b64decode(image_data)
-            except Exception as e:
-                logger.error(f"Error decoding base64 for stanza {stanza_num}: {str(e)}")
-                continue
-            
-            # Save image
-            output_path = OUTPUT_DIR / f"stanza_{stanza_num}.jpg"
-            with open(output_path, "wb") as f:
-                f.write(image_bytes)
-            logger.info(f"Saved image for stanza {stanza_num} to {output_path}")
+def save_stanza_image(stanza_num: str, image_data: str):
+    """Save one stanza image from the response."""
+    # Drop the data URI prefix and decode base64 image straight to disk
+    output_path = OUTPUT_DIR / f"stanza_{stanza_num}.jpg"
+    try:
+        write_base64_to_file(base64_payload(image_data), output_path)
     except Exception as e:
-        logger.error(f"Error saving generated images: {str(e)}")
+        logger.error("Error decoding base64 for stanza %s: %s", stanza_num, e)
+        return
+    logger.info("Saved image for stanza %s to %s", stanza_num, output_path)
 
 def save_cover_image(cover_image_data: str):
     """Save the storybook cover image from the response."""
     try:
-        # Remove data URI prefix if present
-        if cover_image_data.startswith("data:image/jpeg;base64,"):
-            cover_image_data = cover_image_data.replace("data:image/jpeg;base64,", "")
-        
-        # Decode base64 image
+        # Drop the data URI prefix and decode base64 image straight to disk
+        output_path = OUTPUT_DIR / "storybook_cover.jpg"
         try:
-            image_bytes = base64.b64decode(cover_image_data)
+            write_base64_to_file(base64_payload(cover_image_data), output_path)
         except Exception as e:
-            logger.error(f"Error decoding base64 for cover: {str(e)}")
+            logger.error("Error decoding base64 for cover: %s", e)
             return
-        
-        # Save image
-        output_path = OUTPUT_DIR / "storybook_cover.jpg"
-        with open(output_path, "wb") as f:
-            f.write(image_bytes)
-        logger.info(f"Saved storybook cover to {output_path}")
+        logger.info("Saved storybook cover to %s", output_path)
     except Exception as e:
-        logger.error(f"Error saving cover image: {str(e)}")
+        logger.error("Error saving cover image: %s", e)
+
+def stream_response(response: httpx.Response) -> Dict[str, Any]:
+    """Parse a streamed service response, saving images as they arrive.
+    
+    Each stanza image and the cover are decoded to disk as soon as their JSON
+    value is complete, while the rest of the body is still being received, so
+    the full response dict is never built. Only the other top-level fields are
+    collected and returned.
+    """
+    summary: Dict[str, Any] = {}
+    saved_stanzas = 0
+    events = ijson.sendable_list()
+    parser = ijson.parse_coro(events, use_float=True)
+    
+    def handle_events():
+        nonlocal saved_stanzas
+        for prefix, event, value in events:
+            if event not in ("string", "number", "boolean", "null"):
+                continue
+            if prefix.startswith("image_data."):
+                save_stanza_image(prefix[len("image_data."):], value)
+                saved_stanzas += 1
+            elif prefix == "cover_image":
+                if value:
+                    save_cover_image(value)
+            elif "." not in prefix:
+                summary[prefix] = value
+        del events[:]
+    
+    for chunk in response.iter_bytes():
+        parser.send(chunk)
+        handle_events()
+    parser.close()
+    handle_events()
+    
+    if not saved_stanzas:
+        logger.error("No image_data found in response")
+    return summary
 
 def test_illustration_generation():
     """Test the illustration generation endpoint."""
@@ -147,43 +233,37 @@ def test_illustration_generation():
         # Ensure directories exist
         ensure_directories()
         
-        # Create test request
-        request_data = create_test_request()
+        # Create test request body
+        request_body = build_test_request_body()
         
         # Make API request
         logger.info(f"Sending request to illustration service at {SERVICE_URL}...")
-        response = requests.post(
+        with _CLIENT.stream(
+            "POST",
             f"{SERVICE_URL}/generate-illustration",
-            json=request_data,
-            headers={
-                "Content-Type": "application/json",
-                "user-email": TEST_USER_EMAIL
-            }
-        )
-        
-        # Check response
-        response.raise_for_status()
-        response_data = response.json()
+            content=request_body,
+            headers={"Content-Type": "application/json"}
+        ) as response:
+            # Check response, loading the body so errors can log it
+            if response.is_error:
+                response.read()
+            response.raise_for_status()
+            
+            # Save generated and cover images while the body streams in
+            response_data = stream_response(response)
         
         # Log response status and message
         logger.info(f"Response status: {response_data.get('status')}")
         logger.info(f"Response message: {response_data.get('message')}")
         
-        # Save raw response
+        # Save raw response, without the image payloads
         save_raw_response(response_data)
         
-        # Save generated images
-        save_generated_images(response_data)
-        
-        # Save cover image if present
-        if response_data.get("cover_image"):
-            save_cover_image(response_data["cover_image"])
-        
         return response_data
         
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error(f"Error making request to service: {str(e)}")
-        if hasattr(e.response, 'text'):
+        if isinstance(e, httpx.HTTPStatusError):
             logger.error(f"Response text: {e.response.text}")
         raise
     except Exception as e:
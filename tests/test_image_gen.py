@@ -1,36 +1,138 @@
 """Test script for OpenAI image generation with reference images."""
+import asyncio
+import atexit
+import io
 import os
-import base64
+import random
+import shutil
 import logging
-from typing import List
-from openai import OpenAI
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from openai import AsyncOpenAI, OpenAI
+from PIL import Image
 import time
 
+# Prefer the SIMD-accelerated pybase64 codec when installed
+try:
+    import pybase64 as base64
+except ImportError:
+    import base64
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def get_base64_images_from_folder(folder_path: str) -> List[str]:
-    """Load all PNG image files in the given folder and return a list of base64-encoded strings.
+REFERENCE_IMAGES_FOLDER = "tests/test_images"
+# The model downsamples references anyway, so shrink them before upload
+REFERENCE_MAX_SIZE = (1024, 1024)
+REFERENCE_JPEG_QUALITY = 85
+# Upper bound on a single retry delay, in seconds
+MAX_RETRY_DELAY = 30.0
+# Maximum number of concurrent requests in generate_illustrations
+MAX_CONCURRENT_GENERATIONS = 8
+
+ILLUSTRATION_MODEL = "gpt-4.1"
+SYSTEM_PROMPT = "You are an expert children's book illustrator. Use the following input to generate a watercolor-style storybook image."
+
+# IDs of reference images uploaded by this process, deleted again at exit
+_uploaded_file_ids: List[str] = []
+
+def _list_png_files(folder_path: str) -> List[str]:
+    """Return the paths of the PNG files directly inside a folder."""
+    # scandir entries carry the file type, so no extra stat per file
+    with os.scandir(folder_path) as entries:
+        return [
+            entry.path for entry in entries
+            if entry.is_file(follow_symlinks=False) and entry.name.endswith(('.png', '.PNG'))
+        ]
+
+@lru_cache(maxsize=1)
+def _get_client() -> OpenAI:
+    """Return the shared OpenAI client, created on first use."""
+    return OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+
+def _prepare_ref(file_path: str) -> bytes:
+    """Downscale a reference image to at most 1024px and re-encode it as JPEG."""
+    with Image.open(file_path) as image:
+        image.thumbnail(REFERENCE_MAX_SIZE)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=REFERENCE_JPEG_QUALITY, optimize=True)
+        return buffer.getvalue()
+
+@lru_cache(maxsize=None)
+def _upload_reference_image(file_path: str, mtime_ns: int) -> str:
+    """Prepare and upload a reference image once per modification time and return its file ID."""
+    filename = os.path.splitext(os.path.basename(file_path))[0] + ".jpg"
+    prepared = _prepare_ref(file_path)
+    file_id = _get_client().files.create(
+        file=(filename, prepared, "image/jpeg"),
+        purpose="vision"
+    ).id
+    _uploaded_file_ids.append(file_id)
+    return file_id
+
+@atexit.register
+def _delete_uploaded_files():
+    """Delete the reference images uploaded by this run from the OpenAI account."""
+    while _uploaded_file_ids:
+        file_id = _uploaded_file_ids.pop()
+        try:
+            _get_client().files.delete(file_id)
+        except Exception as e:
+            logger.error("Error deleting uploaded file %s: %s", file_id, e)
+
+def _upload_one(file_path: str) -> Optional[str]:
+    """Upload one reference image, returning None on error."""
+    try:
+        return _upload_reference_image(file_path, os.stat(file_path).st_mtime_ns)
+    except Exception as e:
+        logger.error("Error uploading image %s: %s", file_path, e)
+        return None
+
+@lru_cache(maxsize=4)
+def _cached_refs(folder_path: str, mtime_ns: int) -> Tuple[str, ...]:
+    """Upload a folder's reference images once per folder modification time.
     
-    Args:
-        folder_path: Path to the folder containing image files.
-        
-    Returns:
-        List[str]: List of base64 encoded image data strings with data URI prefix.
+    The images are sent as raw bytes through the files API and referenced by
+    file ID, which avoids base64 encoding and its 33% size overhead.
     """
-    base64_images = []
-    for filename in os.listdir(folder_path):
-        file_path = os.path.join(folder_path, filename)
-        if os.path.isfile(file_path) and filename.lower().endswith('.png'):
-            try:
-                with open(file_path, "rb") as image_file:
-                    encoded = base64.b64encode(image_file.read()).decode('utf-8')
-                    data_uri = f"data:image/png;base64,{encoded}"
-                    base64_images.append(data_uri)
-            except Exception as e:
-                logger.error(f"Error encoding image {file_path}: {str(e)}")
-    return base64_images
+    paths = _list_png_files(folder_path)
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        return tuple(file_id for file_id in executor.map(_upload_one, paths) if file_id)
+
+def _backoff_delay(initial_delay: float, attempt: int) -> float:
+    """Return a full-jitter exponential backoff delay, capped at MAX_RETRY_DELAY."""
+    return random.uniform(0, min(MAX_RETRY_DELAY, initial_delay * (2 ** attempt)))
+
+def _build_input(prompt: str, reference_images: Tuple[str, ...]) -> List[Dict[str, Any]]:
+    """Build the Responses API input for a prompt and uploaded reference file IDs."""
+    return [
+        {
+            "role": "system",
+            "content": SYSTEM_PROMPT
+        },
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "input_text",
+                    "text": prompt
+                },
+                *[
+                    {
+                        "type": "input_image",
+                        "file_id": file_id,
+                        "detail": "auto"
+                    }
+                    for file_id in reference_images
+                ]
+            ]
+        }
+    ]
 
 def generate_illustration(
     prompt: str,
@@ -49,48 +151,27 @@ def generate_illustration(
         initial_delay: Initial delay between retries in seconds (default: 1.0)
         
     Returns:
-        str: Base64 encoded generated image
+        str: Path of the saved generated image
     """
+    # Get the OpenAI client and upload reference images once for all attempts
+    client = _get_client()
+    reference_images = _cached_refs(
+        REFERENCE_IMAGES_FOLDER,
+        os.stat(REFERENCE_IMAGES_FOLDER).st_mtime_ns
+    )
+    logger.info("Using %d reference images", len(reference_images))
+    
     for attempt in range(max_retries):
         try:
-            # Initialize OpenAI client
-            client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-            
             # Log request details
-            logger.info(f"Generating illustration with size: {size}, quality: {quality}")
-            logger.debug(f"Prompt: {prompt}")
-            
-            # Get reference images
-            reference_images = get_base64_images_from_folder("tests/test_images")
-            logger.info(f"Using {len(reference_images)} reference images")
+            logger.info("Generating illustration with size: %s, quality: %s", size, quality)
+            logger.debug("Prompt: %s", prompt)
             
             # Prepare the request
             response = client.responses.create(
-                model="gpt-4.1",
+                model=ILLUSTRATION_MODEL,
                 tools=[{"type": "image_generation"}],
-                input=[
-                    {
-                        "role": "system",
-                        "content": "You are an expert children's book illustrator. Use the following input to generate a watercolor-style storybook image."
-                    },
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "input_text",
-                                "text": prompt
-                            },
-                            *[
-                                {
-                                    "type": "input_image",
-                                    "image_url": base64_img,
-                                    "detail": "auto"
-                                }
-                                for base64_img in reference_images
-                            ]
-                        ]
-                    }
-                ]
+                input=_build_input(prompt, reference_images)
             )
             
             # Log response details
@@ -99,22 +180,22 @@ def generate_illustration(
             # Extract base64 string from response
             for output in response.output:
                 if hasattr(output, 'result') and output.result:
-                    # Save the base64 string to a file
-                    with open("response.txt", "w") as f:
-                        f.write(str(response))
+                    # Dump the full response (including the base64 image) only when debugging
+                    if logger.isEnabledFor(logging.DEBUG):
+                        Path("response.txt").write_text(repr(response))
                     
                     # Save the image
                     image_data = output.result
                     output_path = "generated_illustration.png"
                     with open(output_path, "wb") as f:
-                        f.write(base64.b64decode(image_data))
-                    logger.info(f"Saved generated image to: {output_path}")
-                    return image_data
+                        f.write(base64.b64decode(image_data, validate=False))
+                    logger.info("Saved generated image to: %s", output_path)
+                    return output_path
             
             # If we get here, no image data was found
             if attempt < max_retries - 1:
-                delay = initial_delay * (2 ** attempt)  # Exponential backoff
-                logger.warning(f"No image data found in response. Retrying in {delay:.1f} seconds... (Attempt {attempt + 1}/{max_retries})")
+                delay = _backoff_delay(initial_delay, attempt)  # Jittered exponential backoff
+                logger.warning("No image data found in response. Retrying in %.1f seconds... (Attempt %d/%d)", delay, attempt + 1, max_retries)
                 time.sleep(delay)
                 continue
                 
@@ -122,25 +203,78 @@ def generate_illustration(
             
         except Exception as e:
             if attempt < max_retries - 1:
-                delay = initial_delay * (2 ** attempt)
-                logger.warning(f"Error generating illustration: {str(e)}. Retrying in {delay:.1f} seconds... (Attempt {attempt + 1}/{max_retries})")
+                delay = _backoff_delay(initial_delay, attempt)
+                logger.warning("Error generating illustration: %s. Retrying in %.1f seconds... (Attempt %d/%d)", e, delay, attempt + 1, max_retries)
                 time.sleep(delay)
                 continue
-            logger.error(f"Error generating illustration after {max_retries} attempts: {str(e)}", exc_info=True)
+            logger.error("Error generating illustration after %d attempts: %s", max_retries, e, exc_info=True)
             raise
 
+async def generate_illustrations(prompts: List[str]) -> List[Optional[str]]:
+    """Generate illustrations for several prompts concurrently.
+    
+    Reference images are uploaded once before fanning out, and at most
+    MAX_CONCURRENT_GENERATIONS requests are in flight at a time.
+    
+    Args:
+        prompts: The prompts for image generation
+        
+    Returns:
+        List[Optional[str]]: Saved image path per prompt, or None if that prompt failed
+    """
+    reference_images = _cached_refs(
+        REFERENCE_IMAGES_FOLDER,
+        os.stat(REFERENCE_IMAGES_FOLDER).st_mtime_ns
+    )
+    logger.info("Using %d reference images for %d prompts", len(reference_images), len(prompts))
+    
+    client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_GENERATIONS)
+    
+    async def generate_one(index: int, prompt: str) -> Optional[str]:
+        async with semaphore:
+            response = await client.responses.create(
+                model=ILLUSTRATION_MODEL,
+                tools=[{"type": "image_generation"}],
+                input=_build_input(prompt, reference_images)
+            )
+        for output in response.output:
+            if hasattr(output, 'result') and output.result:
+                output_path = f"generated_illustration_{index}.png"
+                with open(output_path, "wb") as f:
+                    f.write(base64.b64decode(output.result, validate=False))
+                logger.info("Saved generated image to: %s", output_path)
+                return output_path
+        logger.warning("No image data found in response for prompt %d", index)
+        return None
+    
+    try:
+        results = await asyncio.gather(
+            *(generate_one(index, prompt) for index, prompt in enumerate(prompts)),
+            return_exceptions=True
+        )
+    finally:
+        await client.close()
+    
+    paths = []
+    for index, result in enumerate(results):
+        if isinstance(result, Exception):
+            logger.error("Error generating illustration for prompt %d: %s", index, result)
+            result = None
+        paths.append(result)
+    return paths
+
 def main():
     """Main function to test image generation."""
     prompt = "Create a watercolor-style children's book illustration of a baby playing with toys in a sunny room"
     
     try:
         # Generate illustration
-        image_data = generate_illustration(prompt=prompt)
+        image_path = generate_illustration(prompt=prompt)
         
-        # Save the generated image
+        # Copy the already decoded image rather than decoding it a second time
         output_path = "generated_illustration.jpg"
-        with open(output_path, "wb") as f:
-            f.write(base64.b64decode(image_data))
+        shutil.copyfile(image_path, output_path)
         logger.info(f"Saved generated image to: {output_path}")
         
     except Exception as e: